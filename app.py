@@ -1,4 +1,10 @@
-from flask import Flask, redirect, request, url_for, session, render_template
+from flask import Flask, redirect, request, url_for, session, render_template, stream_template, jsonify, abort
+from jinja2 import FileSystemBytecodeCache
+import click
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import undefer
+from sqlalchemy.pool import QueuePool
 import os
 import models
 
@@ -8,28 +14,62 @@ import models
 
 app = Flask(__name__)
 app.secret_key = 'super secrete key'
+app.config['TEMPLATES_AUTO_RELOAD'] = False
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache()
 
 db_name = 'Congo.db'
-sqlite_uri = f'sqlite:///{os.path.abspath(os.path.curdir)}/{db_name}'
+db_path = os.path.join(os.path.abspath(os.path.curdir), db_name)
+sqlite_uri = f'sqlite:///{db_path}'
 app.config['SQLALCHEMY_DATABASE_URI'] = sqlite_uri
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'poolclass': QueuePool,
+    'pool_size': 5,
+    'max_overflow': 10,
+    'pool_pre_ping': True,
+    'query_cache_size': 1200,
+    'connect_args': {'check_same_thread': False, 'timeout': 30},
+}
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.execute('PRAGMA cache_size=-20000')
+    cursor.close()
+
 db = models.db
 db.init_app(app)
 
-with app.app_context():
+def init_db():
     db.create_all()
+    migrated = models.migrate_db()
+    models.add_items()
+    return migrated
+
+@app.cli.command('init-db')
+def init_db_command():
+    migrated = init_db() or db_migrated
+    if db_created:
+        click.echo(f'Created {db_name}')
+    elif migrated:
+        click.echo(f'Upgraded existing {db_name} to schema version {models.SCHEMA_VERSION}')
+    else:
+        click.echo(f'{db_name} already exists and is up to date')
+
+db_created = not os.path.exists(db_path)
+with app.app_context():
+    db_migrated = init_db() if db_created else models.migrate_db()
+
+ALLOWED_ENDPOINTS = frozenset({
+    'index', 'register', 'login_form', 'create_user', 'login', 'get_orders', 'static',
+})
 
 @app.before_request
 def check_login():
-    allowed_routes = [
-        url_for('index'),
-        url_for('register'),
-        url_for('login_form'),
-        url_for('create_user'),
-        url_for('login'),
-        url_for('get_orders'),
-    ]
-    if 'username' not in session and request.path not in allowed_routes and not request.path.startswith('/static'):
+    if 'username' not in session and request.endpoint not in ALLOWED_ENDPOINTS:
         return redirect(url_for('login_form'))
 
 @app.route('/')
@@ -45,13 +85,14 @@ def register():
 
 @app.route('/users/', methods=['POST'])
 def create_user():
-    if models.has_user(request.form['username']):
-        return render_template('register_form.html', title='Home', username=session.get('username'), username_message='Username already exists. Please choose another.')
     if request.form['password'] != request.form['password_conf']:
         return render_template('register_form.html', title='Home', username=session.get('username'), password_message='Passwords must match.')
     # Create new user in database
     if not models.create_user(request.form['username'], request.form['name'], request.form['email'],
                               request.form['address'], request.form['payment'], request.form['password']):
+        # Only look up why the insert was skipped once it has failed
+        if models.has_user(request.form['username']):
+            return render_template('register_form.html', title='Home', username=session.get('username'), username_message='Username already exists. Please choose another.')
         return render_template('register_form.html', title='Home', username=session.get('username'), create_message='An unknown error occured when creating this User')
     return redirect(url_for('login_form'))
 
@@ -63,7 +104,7 @@ def login_form():
 @app.route('/login/', methods=['POST'])
 def login():
     username = request.form["username"]
-    user = models.User.query.filter_by(username=username).first()
+    user = models.User.query.options(undefer(models.User.password)).filter_by(username=username).first()
     if not user or user.password != request.form["password"]:
         return render_template('login_form.html', title='Login', username=session.get('username'), message='Wrong username or password')
     else:
@@ -72,77 +113,90 @@ def login():
 
 @app.route('/items/', methods=['GET'])
 def get_items():
-    session['items'] = models.add_items()
-    items = models.Item.query.all()
-    return render_template('items.html', title='Shop', username=session.get('username'), items=items)
+    items = models.all_items()
+    return stream_template('items.html', title='Shop', username=session.get('username'), items=items)
 
-@app.route('/items/<itemid>/', methods=['GET'])
+@app.route('/items/<int:itemid>/', methods=['GET'])
 def get_item(itemid):
-    item = models.Item.query.filter_by(id=itemid).first()
+    item = db.session.get(models.Item, itemid)
+    if item is None:
+        abort(404)
     return render_template('get_item.html', title='Shop', username=session.get('username'), item=item)
 
 @app.route('/cart/', methods=['POST'])
 def add_to_cart():
-    if request.form['item'] in session:
-        num_in_cart = session[request.form['item']] + int(request.form['quantity'])
-        session[request.form['item']] = num_in_cart
-    else:
-        session[request.form['item']] = int(request.form['quantity'])
-    return redirect(url_for('show_cart'))
+    cart = session.setdefault('cart', {})
+    cart[request.form['item']] = cart.get(request.form['item'], 0) + int(request.form['quantity'])
+    session.modified = True
+    return jsonify(ok=True, cart_count=sum(cart.values())), 200
 
 @app.route('/cart/', methods=['GET'])
 def show_cart():
-    items = session['items']
-    return render_template('show_cart.html', title='Cart', username=session.get('username'), items=items)
+    items = session.get('cart', {})
+    return stream_template('show_cart.html', title='Cart', username=session.get('username'), items=items)
 
 
 @app.route('/cart/', methods=['DELETE'])
 def delete_cart_item():
     item = request.json['item']
-    # I hate this so much
-    if item not in session:
+    cart = session.get('cart', {})
+    if item not in cart:
         return 'Item not in cart.', 404
-    del session[item]
+    del cart[item]
+    session.modified = True
     return '', 200
 
 
+def current_user():
+    # Sessions from before the profile moved server-side still carry it
+    if 'user' in session:
+        session.pop('user')
+    user = models.user_profile(session['username'])
+    if user is None:
+        session.clear()
+    return user
+
+
+def cart_items():
+    cart = session.get('cart', {})
+    rows = db.session.execute(
+        db.select(models.Item.id, models.Item.name, models.Item.price_cents)
+        .where(models.Item.name.in_(cart))
+    ).all()
+    return [(x, cart[x.name]) for x in rows if cart[x.name]]
+
+
 @app.route('/checkout/', methods=['GET'])
 def get_checkout():
-    items = [
-        (x, session[x.name])
-        for x in models.Item.query.all()
-        if x.name in session and session[x.name]
-    ]
-    total = sum(x[0].price * x[1] for x in items)
-    user = models.User.query.filter_by(username=session['username']).first()
-    return render_template('checkout.html', title='Checkout', username=session.get('username'), items=items, total=f"{total:,.2f}", user=user)
+    items = cart_items()
+    total_cents = sum(x[0].price_cents * x[1] for x in items)
+    user = current_user()
+    if user is None:
+        return redirect(url_for('login_form'))
+    return render_template('checkout.html', title='Checkout', username=session.get('username'), items=items, total=f"{total_cents / 100:,.2f}", user=user)
 
 
 @app.route('/orders/', methods=['POST'])
 def post_order():
-    user = models.User.query.filter_by(username=session['username']).first()
-    items = [
-        (x, session[x.name])
-        for x in models.Item.query.all()
-        if x.name in session and session[x.name]
-    ]
-    total = sum(x[0].price * x[1] for x in items)
+    user = current_user()
+    if user is None:
+        return '', 401
+    items = cart_items()
+    total_cents = sum(x[0].price_cents * x[1] for x in items)
 
     order = models.Order(
-        name=user.name,
-        address=user.address,
-        total=total,
+        name=user['name'],
+        address=user['address'],
+        total_cents=total_cents,
     )
     db.session.add(order)
-    db.session.commit()
-
-    for item, qty in items:
-        db.session.add(models.OrderItem(order_id=order.id, item_id=item.id, quantity=qty))
+    db.session.flush()
 
+    rows = [{'order_id': order.id, 'item_id': item.id, 'quantity': qty} for item, qty in items]
+    db.session.bulk_insert_mappings(models.OrderItem, rows)
     db.session.commit()
 
-    for item in session.get('items'):
-        session.pop(item, None)
+    session['cart'] = {}
 
     return '', 200
 
@@ -150,10 +204,6 @@ def post_order():
 @app.route('/orders/', methods=['GET'])
 def get_orders():
     orders = models.Order.query.all()
-    for order in orders:
-        for item in order.items:
-            print(item.item)
-
     return render_template('orders.html', title='Orders', username=session.get('username'), orders=orders)
 
 
@@ -166,4 +216,5 @@ def logout():
     session.clear()
     return redirect(url_for('login_form'))
 
-app.run()
+if __name__ == '__main__':
+    app.run()
@@ -1,151 +1,180 @@
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects.sqlite import insert
+import time
 
 db = SQLAlchemy()
 
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(80), unique=True, nullable=False)
+    username = db.Column(db.String(80), unique=True, index=True, nullable=False)
     name = db.Column(db.String(100), unique=False, nullable=False)
     email = db.Column(db.String(150), unique=True, nullable=False)
-    address = db.Column(db.String(256), unique=False, nullable=False)
-    password = db.Column(db.String(64), unique=False, nullable=True)
-    payment = db.Column(db.String(16), unique=True, nullable=False)
+    address = db.deferred(db.Column(db.String(256), unique=False, nullable=False))
+    password = db.deferred(db.Column(db.String(64), unique=False, nullable=True))
+    payment = db.deferred(db.Column(db.String(16), unique=True, nullable=False))
 
     def __repr__(self):
         return f'User: {self.name}, {self.email}'
 
 def create_user(username, name, email, address, payment, password):
-    try:
-        new_user = User(username=username, name=name, email=email, address=address, payment=payment, password=password)
-        db.session.add(new_user)
-        db.session.commit()
-        return True
-    except Exception as e:
-        db.session.rollback()
-        return False
+    stmt = insert(User).values(
+        username=username, name=name, email=email, address=address, payment=payment, password=password,
+    ).on_conflict_do_nothing()
+    result = db.session.execute(stmt)
+    db.session.commit()
+    _users_cache.pop(username, None)
+    return result.rowcount == 1
 
 def has_user(username):
-    return db.session.query(User).filter_by(username=username).first() is not None
+    return db.session.query(db.exists().where(User.username == username)).scalar()
+
+USERS_TTL = 60
+_users_cache = {}
+
+def user_profile(username):
+    now = time.monotonic()
+    entry = _users_cache.get(username)
+    if entry is None or now >= entry[0]:
+        row = db.session.execute(
+            db.select(User.name, User.address).where(User.username == username)
+        ).first()
+        if row is None:
+            _users_cache.pop(username, None)
+            return None
+        entry = (now + USERS_TTL, {'name': row.name, 'address': row.address})
+        _users_cache[username] = entry
+    return entry[1]
 
 class Item(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(32), unique=True, nullable=False)
+    name = db.Column(db.String(32), unique=True, index=True, nullable=False)
     image = db.Column(db.String(64), unique=True, nullable=False)
     description = db.Column(db.String(1000), unique=False, nullable=False)
-    price = db.Column(db.Numeric(10,2),unique = False,nullable=False) 
+    price_cents = db.Column(db.Integer, unique=False, nullable=False)
+
+    @property
+    def price(self):
+        return self.price_cents / 100
 
     def __repr__(self):
         return f'Item: {self.name}'
 
+ITEMS_TTL = 60
+_items_cache = {'items': None, 'expires': 0}
+
+def all_items():
+    now = time.monotonic()
+    if _items_cache['items'] is None or now >= _items_cache['expires']:
+        _items_cache['items'] = db.session.execute(db.select(Item.id, Item.name, Item.image)).all()
+        _items_cache['expires'] = now + ITEMS_TTL
+    return _items_cache['items']
+
 
 class OrderItem(db.Model):
+    __table_args__ = (db.Index('ix_order_item_order_id_item_id', 'order_id', 'item_id'),)
+
     id = db.Column(db.Integer, primary_key=True)
     order_id = db.Column(db.Integer, db.ForeignKey('order.id'))
     item_id = db.Column(db.Integer, db.ForeignKey('item.id'))
     quantity = db.Column(db.Integer, nullable=False, default=1)
 
-    item = db.relationship('Item', backref='order_item')
+    item = db.relationship('Item', backref='order_item', lazy='joined')
 
 
 class Order(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False)
     address = db.Column(db.String, nullable=False)
-    total = db.Column(db.Float, nullable=False)
-
-    items = db.relationship('OrderItem', backref='order', cascade='all, delete-orphan')
-
+    total_cents = db.Column(db.Integer, nullable=False)
+
+    items = db.relationship('OrderItem', backref='order', cascade='all, delete-orphan', lazy='selectin')
+
+    @property
+    def total(self):
+        return self.total_cents / 100
+
+
+_POCKET_WATCH_DESC = (
+    'This is a totally normal pocket watch that only lets you travel time... '
+    'I mean tell time. Nothing other than telling time... except maybe for the occasional '
+    'glitch that sends you to different eras. But honestly, who needs reliable time-telling '
+    'anyway when you can accidentally end up in the Victorian era or the Jurassic period? '
+    'It\'s all fun and games until you realize your meeting starts in five minutes and you\'re '
+    'wearing a top hat and monocle.'
+)
+
+_ICE_CREAM_MACHINE_DESC = (
+    'This ice cream machine allows you to have ice cream of any flavor you desire. It has all toppings you can think of. '
+    'You, also, never have to do any maintanence. Nothing special really... except maybe the fact that it conjures the creamiest, most heavenly scoops '
+    'with just a thought. Imagine a machine that reads your deepest dessert dreams and manifests them instantly. And no maintenance? That\'s right, it\'s '
+    'self-cleaning and as if by magic, it never runs out of ingredients. It\'s like having your personal Willy Wonka in your kitchen.'
+)
+
+_CLOAK_DESC = (
+    'Like all cloaks, it is super cool and makes you look cool. Or I suppose it makes you look not at all since people cannot see you. '
+    'Did I mention that? It makes you invisible. Perfect for slipping out of boring meetings or sneaking into secret wizard gatherings. '
+    'But be careful not to get lost in your own invisibility-after all, with great power comes great responsibility. We wouldn\'t want '
+    'any illegal things happening. Whether you\'re avoiding an awkward encounter or seeking a thrilling adventure, this cloak has got you '
+    'covered... literally.'
+)
+
+_HELMET_DESC = (
+    'This football helmet provides superb protection. Ironically, it also increases the neural efficiency of the wearer. That\'s funny '
+    'because football gives you concussions which can lower brain function. Imagine a helmet that not only guards your noggin but also '
+    'sharpens it! While it keeps you safe from those brutal tackles, or whatever you need a helmet for these days, it somehow also boosts '
+    'your brainpower-turning you into a gridiron genius. But beware, even a super-smart helmet can\'t stop you from forgetting where you '
+    'your keys after the game. Ideal for the player who wants to outthink the competition, both on and off the field. It\'s all about '
+    'about balancing brawn with brains.'
+)
+
+_WORMHOLE_GENERATOR_DESC = (
+    'This generator is a proprietary technology that creates wormholes. These incredibly intricate machines allow you to travel long '
+    'distances in just a few steps. User manual sold seperately, but who needs instruction for interdimensional travel anyway? Just '
+    'press the shiny red button and hope for the best. Nothing bad as ever happened from shiny red buttons, right? Whether you\'re '
+    'late for a meeting on the other side of the planet or simply curious about what\'s in your neighbor\'s fridge. This handy gadget '
+    'has got you covered. Just remember to close the wormhole behind you. You don\'t want any unexpected visitors from alternate '
+    'realities crashing your party. Unless you do for some reason. We don\'t judge, just take your money.'
+)
+
+ITEMS = (
+    ('Normal Pocket Watch', 'watch.jpg', _POCKET_WATCH_DESC, 10099),
+    ('Normal Ice Cream Machine', 'ice_cream.jpg', _ICE_CREAM_MACHINE_DESC, 5249),
+    ('Normal Cloak', 'cloak.jpg', _CLOAK_DESC, 1000),
+    ('Normal Helmet', 'helmet.jpg', _HELMET_DESC, 1200),
+    ('Normal Wormhole Generator', 'generator.jpg', _WORMHOLE_GENERATOR_DESC, 10000000),
+)
 
 def add_items():
-    items = []
-    items.append(add_pocket_watch())
-    items.append(add_ice_cream_machine())
-    items.append(add_cloak())
-    items.append(add_helmet())
-    items.append(add_wormhole_generator())
-    return items
-
-def add_pocket_watch():
-    name = 'Normal Pocket Watch'
-    if Item.query.filter_by(name=name).first():
-        return name
-    image = 'watch.jpg'
-    desc = ('This is a totally normal pocket watch that only lets you travel time... '
-           'I mean tell time. Nothing other than telling time... except maybe for the occasional '
-           'glitch that sends you to different eras. But honestly, who needs reliable time-telling '
-           'anyway when you can accidentally end up in the Victorian era or the Jurassic period? '
-           'It\'s all fun and games until you realize your meeting starts in five minutes and you\'re '
-           'wearing a top hat and monocle.')
-    itemPrice = 100.99
-    item = Item(name=name, image=image, description=desc,price = itemPrice)
-    db.session.add(item)
+    names = [name for name, _, _, _ in ITEMS]
+    existing = set(db.session.execute(db.select(Item.name).where(Item.name.in_(names))).scalars())
+    db.session.bulk_insert_mappings(Item, [
+        {'name': name, 'image': image, 'description': desc, 'price_cents': price_cents}
+        for name, image, desc, price_cents in ITEMS
+        if name not in existing
+    ])
     db.session.commit()
-    return name
-
-def add_ice_cream_machine():
-    name = 'Normal Ice Cream Machine'
-    if Item.query.filter_by(name=name).first():
-        return name
-    image = 'ice_cream.jpg'
-    desc = ('This ice cream machine allows you to have ice cream of any flavor you desire. It has all toppings you can think of. '
-           'You, also, never have to do any maintanence. Nothing special really... except maybe the fact that it conjures the creamiest, most heavenly scoops '
-           'with just a thought. Imagine a machine that reads your deepest dessert dreams and manifests them instantly. And no maintenance? That\'s right, it\'s '
-           'self-cleaning and as if by magic, it never runs out of ingredients. It\'s like having your personal Willy Wonka in your kitchen.')
-    itemPrice = 52.49
-    item = Item(name=name, image=image, description=desc,price = itemPrice)
-    db.session.add(item)
-    db.session.commit()
-    return name
-
-def add_cloak():
-    name = 'Normal Cloak'
-    if Item.query.filter_by(name=name).first():
-        return name
-    image = 'cloak.jpg'
-    desc = ('Like all cloaks, it is super cool and makes you look cool. Or I suppose it makes you look not at all since people cannot see you. '
-           'Did I mention that? It makes you invisible. Perfect for slipping out of boring meetings or sneaking into secret wizard gatherings. '
-           'But be careful not to get lost in your own invisibility-after all, with great power comes great responsibility. We wouldn\'t want '
-           'any illegal things happening. Whether you\'re avoiding an awkward encounter or seeking a thrilling adventure, this cloak has got you '
-           'covered... literally.')
-    itemPrice = 10.00
-    item = Item(name=name, image=image, description=desc,price = itemPrice)
-    db.session.add(item)
-    db.session.commit()
-    return name
-
-def add_helmet():
-    name = 'Normal Helmet'
-    if Item.query.filter_by(name=name).first():
-        return name
-    image = 'helmet.jpg'
-    desc = ('This football helmet provides superb protection. Ironically, it also increases the neural efficiency of the wearer. That\'s funny '
-           'because football gives you concussions which can lower brain function. Imagine a helmet that not only guards your noggin but also '
-           'sharpens it! While it keeps you safe from those brutal tackles, or whatever you need a helmet for these days, it somehow also boosts '
-           'your brainpower-turning you into a gridiron genius. But beware, even a super-smart helmet can\'t stop you from forgetting where you '
-           'your keys after the game. Ideal for the player who wants to outthink the competition, both on and off the field. It\'s all about '
-           'about balancing brawn with brains.')
-    itemPrice = 12.00
-    item = Item(name=name, image=image, description=desc,price = itemPrice)
-    db.session.add(item)
-    db.session.commit()
-    return name
-
-def add_wormhole_generator():
-    name = 'Normal Wormhole Generator'
-    if Item.query.filter_by(name=name).first():
-        return name
-    image = 'generator.jpg'
-    desc = ('This generator is a proprietary technology that creates wormholes. These incredibly intricate machines allow you to travel long '
-           'distances in just a few steps. User manual sold seperately, but who needs instruction for interdimensional travel anyway? Just '
-           'press the shiny red button and hope for the best. Nothing bad as ever happened from shiny red buttons, right? Whether you\'re '
-           'late for a meeting on the other side of the planet or simply curious about what\'s in your neighbor\'s fridge. This handy gadget '
-           'has got you covered. Just remember to close the wormhole behind you. You don\'t want any unexpected visitors from alternate '
-           'realities crashing your party. Unless you do for some reason. We don\'t judge, just take your money.')
-    itemPrice = 100000.00
-    item = Item(name=name, image=image, description=desc,price = itemPrice)
-    db.session.add(item)
+
+SCHEMA_VERSION = 1
+
+def _columns(table):
+    return {row.name for row in db.session.execute(db.text(f'PRAGMA table_info("{table}")'))}
+
+def migrate_db():
+    version = db.session.execute(db.text('PRAGMA user_version')).scalar()
+    if version >= SCHEMA_VERSION:
+        return False
+    # Version 1: item prices and order totals are stored as integer cents
+    if 'price_cents' not in _columns('item'):
+        db.session.execute(db.text('ALTER TABLE item ADD COLUMN price_cents INTEGER NOT NULL DEFAULT 0'))
+        db.session.execute(db.text('UPDATE item SET price_cents = CAST(ROUND(price * 100) AS INTEGER)'))
+        db.session.execute(db.text('ALTER TABLE item DROP COLUMN price'))
+    if 'total_cents' not in _columns('order'):
+        db.session.execute(db.text('ALTER TABLE "order" ADD COLUMN total_cents INTEGER NOT NULL DEFAULT 0'))
+        db.session.execute(db.text('UPDATE "order" SET total_cents = CAST(ROUND(total * 100) AS INTEGER)'))
+        db.session.execute(db.text('ALTER TABLE "order" DROP COLUMN total'))
+    db.session.execute(db.text(f'PRAGMA user_version = {SCHEMA_VERSION}'))
     db.session.commit()
-    return name
+    return True
 
 if __name__ == '__main__':
     print("hello world")